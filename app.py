@@ -1,107 +1,94 @@
 import streamlit as st
 import os
+import re
 import json
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from document_processor import DocumentProcessor
-from rag_pipeline import MultiModalRAG
-import shutil
+from patterns import ID_PATTERN
 
 # Load environment variables
 load_dotenv()
 
+# Words that signal the user wants to see a visual
+VISUAL_KW = frozenset({
+    "chart", "graph", "plot", "trend", "table", "figure", "diagram",
+    "image", "picture", "photo", "visual", "illustration"
+})
+# Whole words only (plus plurals), so "paragraph", "stable" or "plotting" don't trigger the selector
+_VISUAL_KW_RE = re.compile(r"\b(?:" + "|".join(sorted(VISUAL_KW)) + r")s?\b", re.IGNORECASE)
+
+@functools.lru_cache(maxsize=4096)
+def _parse_img_meta(raw: str) -> tuple:
+    """
+    Parses the JSON image metadata of a chunk (Chroma only stores scalar metadata).
+    Memoized on the raw string, so chunks retrieved again on later turns aren't re-parsed.
+    """
+    return tuple(json.loads(raw))
+
 st.set_page_config(page_title="Multi-Modal RAG QA", layout="wide", page_icon="🤖")
 
+@st.cache_resource
+def _load_css():
+    """
+    Reads the stylesheet once per server process instead of rebuilding it on every rerun.
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "style.css"), encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>"
+
 # Custom CSS for Premium UI
-st.markdown("""
-<style>
-    /* Global Styles */
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600&display=swap');
-    
-    body {
-        font-family: 'Inter', sans-serif;
-        background-color: #0e1117;
-        color: #fafafa;
-    }
-    
-    /* Sidebar Styling */
-    [data-testid="stSidebar"] {
-        background-color: #161b22;
-        border-right: 1px solid #30363d;
-    }
-    
-    [data-testid="stSidebar"] h1 {
-        font-size: 1.5rem;
-        color: #58a6ff;
-        margin-bottom: 2rem;
-    }
-    
-    /* Input Fields */
-    .stTextInput > div > div > input {
-        background-color: #0d1117;
-        color: #c9d1d9;
-        border: 1px solid #30363d;
-        border-radius: 6px;
-    }
-    
-    /* Buttons */
-    .stButton > button {
-        background-color: #238636;
-        color: white;
-        border: none;
-        border-radius: 6px;
-        padding: 0.5rem 1rem;
-        font-weight: 600;
-        width: 100%;
-        transition: background-color 0.2s ease;
-    }
-    
-    .stButton > button:hover {
-        background-color: #2ea043;
-    }
-    
-    /* Headers */
-    h1, h2, h3 {
-        color: #e6edf3;
-        font-weight: 600;
-    }
-    
-    /* Chat Message Styling */
-    [data-testid="stChatMessage"] {
-        border-radius: 10px;
-        padding: 1rem;
-        margin-bottom: 1rem;
-    }
-    
-    [data-testid="stChatMessage"][data-testid="user"] {
-        background-color: #1f6feb22;
-        border-left: 4px solid #1f6feb;
-    }
-    
-    [data-testid="stChatMessage"][data-testid="assistant"] {
-        background-color: #23863622;
-        border-left: 4px solid #238636;
-    }
+# (Streamlit drops elements that a rerun doesn't emit again, so the tag itself is re-sent each run)
+st.markdown(_load_css(), unsafe_allow_html=True)
+
+class _DegradedExtraction(Exception):
+    """
+    Carries the documents of a run in which some Vision calls failed.
+    Raised out of the cached function so Streamlit doesn't cache the degraded result.
+    """
+    def __init__(self, docs_raw, failures):
+        super().__init__(f"{failures} Vision calls failed")
+        self.docs_raw = docs_raw
+        self.failures = failures
+
+@st.cache_data(show_spinner=False, persist="disk")
+def _process_pdf_cached(file_bytes: bytes) -> list[dict]:
+    """
+    Runs the full extraction pipeline once per distinct PDF (keyed by its content).
+    Returns plain dicts so the result can be pickled to Streamlit's disk cache.
+    Only complete results are cached: if any Vision call failed, _DegradedExtraction is raised
+    so the next upload retries (successful calls are still served from the Vision cache).
+    """
+    # Name the temp file after the content hash so crops of different uploads never overwrite each other
+    digest = hashlib.sha256(file_bytes).hexdigest()[:16]
+    temp_path = f"temp_{digest}.pdf"
+    with open(temp_path, "wb") as f:
+        f.write(file_bytes)
     
-    /* Success/Error/Warning Messages */
-    .stAlert {
-        background-color: #161b22;
-        border: 1px solid #30363d;
-        color: #c9d1d9;
-    }
+    # Imported lazily so the first page render doesn't wait for the PyMuPDF/LangChain import tree
+    from document_processor import DocumentProcessor
     
-    /* Expander */
-    .streamlit-expanderHeader {
-        background-color: #161b22;
-        color: #c9d1d9;
-        border-radius: 6px;
-    }
+    try:
+        processor = DocumentProcessor()
+        # process_pdf is a generator: drain it before the temp file is removed
+        docs_raw = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in processor.process_pdf(temp_path)]
+    finally:
+        os.remove(temp_path)
+        
+    if processor.vision_failures:
+        raise _DegradedExtraction(docs_raw, processor.vision_failures)
+    return docs_raw
+
+@st.cache_resource(max_entries=1)
+def get_rag_system():
+    """
+    Returns the RAG instance shared by all sessions of the server.
+    Cleared on its own after ingestion, so no other cached resource is dropped.
+    """
+    # Imported lazily so the first page render doesn't wait for the ChromaDB/LangChain import tree
+    from rag_pipeline import MultiModalRAG
     
-    /* Hide Streamlit Branding */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    header {visibility: hidden;}
-</style>
-""", unsafe_allow_html=True)
+    return MultiModalRAG()
 
 # Application Header
 with st.container():
@@ -137,25 +124,25 @@ with st.sidebar:
     if process_btn:
         if uploaded_file and os.getenv("OPENAI_API_KEY"):
             with st.spinner("🔍 Analyzing document structure (Text + Vision)..."):
-                # Save uploaded file temporarily
-                with open("temp.pdf", "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                
                 st.info("ℹ️ Note: Deep Vision analysis is enabled. Processing takes ~10-15s per page.")
                 
-                # Process
-                processor = DocumentProcessor()
-                documents = processor.process_pdf("temp.pdf")
+                # Process (cached by file content, so re-uploading the same PDF is instant)
+                try:
+                    docs_raw = _process_pdf_cached(uploaded_file.getbuffer().tobytes())
+                except _DegradedExtraction as e:
+                    docs_raw = e.docs_raw
+                    st.warning(f"⚠️ {e.failures} Vision calls failed, some visuals may be missing. Process the document again to retry them.")
+                from langchain_core.documents import Document
+                documents = [Document(**d) for d in docs_raw]
                 
                 # Ingest documents into the vector store
                 # (Collection reset is handled in rag_pipeline.py to avoid locking issues)
-                    
-                rag = MultiModalRAG()
+                # Drop the cached instance (stale image paths and collection handle) for every session,
+                # so the ingesting instance becomes the one all chats use
+                get_rag_system.clear()
+                rag = get_rag_system()
                 rag.ingest_documents(documents)
                 
-                # Clear cache so the new RAG instance picks up the new database
-                st.cache_resource.clear()
-                
                 st.sidebar.success(f"✅ Indexed {len(documents)} pages!")
         elif not os.getenv("OPENAI_API_KEY"):
             st.sidebar.error("⚠️ API Key missing")
@@ -171,10 +158,6 @@ for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
-@st.cache_resource
-def get_rag_system():
-    return MultiModalRAG()
-
 # Chat Input
 if prompt := st.chat_input("Ask about your document..."):
     if not os.getenv("OPENAI_API_KEY"):
@@ -189,43 +172,25 @@ if prompt := st.chat_input("Ask about your document..."):
                 try:
                     # Use cached RAG system
                     rag = get_rag_system()
-                    qa_chain = rag.get_qa_chain()
-                    
-                    # Get the answer from the chain (it returns a string directly)
-                    answer = qa_chain.invoke(prompt)
-                    
-                    # Get source documents separately from the retriever
-                    # Using the vector store from the cached rag instance
-                    retriever = rag.vector_store.as_retriever(search_kwargs={"k": 5})
-                    source_docs = retriever.invoke(prompt)
+                    answer_chain = rag.get_answer_chain()
                     
-                    st.markdown(answer)
-                    
-                    # Store answer first to ensure UI consistency
-                    st.session_state.messages.append({"role": "assistant", "content": answer})
+                    # Retrieve once; the same docs feed the answer and the visual candidates
+                    source_docs = rag.get_retriever().invoke(prompt)
                     
                     # Collect all candidates (and check for strict ID links in text)
-                    candidates = []
-                    all_images_data = [] 
-                    
-                    import re
-                    # Regex to find IDs in text: e.g. [Detected Table ID: 52a1b3c4]
-                    id_pattern = re.compile(r"ID:\s*([a-zA-Z0-9-]+)\]")
+                    # Stored as parallel lists indexed by candidate position
+                    paths, pages, types, descs, markdowns, linked = [], [], [], [], [], []
                     
                     # 1. Collect all IDs explicitly mentioned in the retrieved text chunks
-                    found_ids_in_context = set()
-                    for doc in source_docs:
-                        matches = id_pattern.findall(doc.page_content)
-                        found_ids_in_context.update(matches)
+                    found_ids_in_context = {m.group(1) for doc in source_docs for m in ID_PATTERN.finditer(doc.page_content)}
                     
-                    unique_id_counter = 0
                     for doc in source_docs:
                         if "image_metadata" in doc.metadata:
                             try:
-                                img_meta_list = json.loads(doc.metadata["image_metadata"])
+                                img_meta_list = _parse_img_meta(doc.metadata["image_metadata"])
                                 for item in img_meta_list:
                                     path = item.get("path")
-                                    if path and os.path.exists(path):
+                                    if path and path in rag.valid_image_paths:
                                         # Check if this visual's ID was cited in the text
                                         # Note: Old docs might not have "id" field, handle gracefully
                                         visual_id = item.get("id", "")
@@ -233,32 +198,45 @@ if prompt := st.chat_input("Ask about your document..."):
                                         
                                         desc_prefix = "[DIRECTLY LINKED] " if is_directly_linked else ""
                                         
-                                        candidates.append({
-                                            "id": unique_id_counter,
-                                            "type": item.get("type", "figure"),
-                                            "description": f"{desc_prefix}{item.get('description', '')[:300]}",
-                                            "is_linked": is_directly_linked
-                                        })
-                                        
-                                        all_images_data.append({
-                                            "path": path,
-                                            "page": doc.metadata.get('page', 'N/A'),
-                                            "markdown": item.get("markdown", ""),
-                                            "is_linked": is_directly_linked
-                                        })
-                                        unique_id_counter += 1
+                                        paths.append(path)
+                                        pages.append(doc.metadata.get('page', 'N/A'))
+                                        types.append(item.get("type", "figure"))
+                                        descs.append(f"{desc_prefix}{item.get('description', '')[:300]}")
+                                        markdowns.append(item.get("markdown", ""))
+                                        linked.append(is_directly_linked)
                             except json.JSONDecodeError:
                                 pass
                     
+                    # LLM-facing view of the candidates
+                    candidates = [
+                        {"id": i, "type": t, "description": d, "is_linked": l}
+                        for i, (t, d, l) in enumerate(zip(types, descs, linked))
+                    ]
+                    
+                    # Skip the selector LLM call for plain text questions with no linked visuals
+                    any_linked = any(linked)
+                    kw_hit = _VISUAL_KW_RE.search(prompt) is not None
+                    
+                    # The answer and the visual selection are independent LLM calls: run them concurrently
+                    with ThreadPoolExecutor(max_workers=2) as executor:
+                        fut_ans = executor.submit(answer_chain.invoke, {"input": prompt, "context": source_docs})
+                        fut_sel = None
+                        if candidates and (any_linked or kw_hit):
+                            fut_sel = executor.submit(rag.select_best_visual_match, prompt, candidates)
+                        answer = fut_ans.result()
+                        selection = fut_sel.result() if fut_sel else None
+                    
+                    st.markdown(answer)
+                    
+                    # Store answer first to ensure UI consistency
+                    st.session_state.messages.append({"role": "assistant", "content": answer})
+                    
                     # Select the visual matches
                     winner_idx_list = [] # Keep track of what we showed prominently
                     
                     if candidates:
                         # st.write(f"DEBUG: Found {len(candidates)} candidates.") # Uncomment for UI debug
                         
-                        with st.spinner("🔍 Analyzing visual intent..."):
-                            selection = rag.select_best_visual_match(prompt, candidates)
-                        
                         if selection:
                             selected_indices = selection.get("selected_indices", [])
                             # Fallback for backward compatibility if model returns old format
@@ -283,28 +261,25 @@ if prompt := st.chat_input("Ask about your document..."):
                                 
                                 cols = st.columns(2) # Grid layout
                                 for i, idx in enumerate(selected_indices):
-                                    if 0 <= idx < len(all_images_data):
-                                        item = all_images_data[idx]
+                                    if 0 <= idx < len(paths):
                                         with cols[i % 2]:
-                                            st.image(item["path"], caption=f"Page {item['page']}", use_container_width=True)
-                                            if item.get("markdown"):
+                                            st.image(paths[idx], caption=f"Page {pages[idx]}", use_container_width=True)
+                                            if markdowns[idx]:
                                                 with st.expander("📄 Table Data"):
-                                                    st.markdown(item["markdown"])
+                                                    st.markdown(markdowns[idx])
                                                     
                             else:
                                 # Specific Mode - Take the first one (or iterate if multiple specific matches found)
                                 for idx in selected_indices:
-                                    if 0 <= idx < len(all_images_data):
-                                        winner = all_images_data[idx]
-                                        
+                                    if 0 <= idx < len(paths):
                                         st.markdown(f"### 🎯 Most Relevant Visual")
                                         if reason:
                                             st.info(f"**Selected:** {reason}")
-                                        st.image(winner["path"], caption=f"Selected Visual from Page {winner['page']}", use_container_width=True)
+                                        st.image(paths[idx], caption=f"Selected Visual from Page {pages[idx]}", use_container_width=True)
                                         
-                                        if winner.get("markdown"):
+                                        if markdowns[idx]:
                                             st.markdown("#### 📄 Extracted Table Data")
-                                            st.markdown(winner["markdown"])
+                                            st.markdown(markdowns[idx])
                                         
                                         # Limit to 1 in specific mode to avoid clutter unless strictly needed
                                         break 
@@ -315,19 +290,19 @@ if prompt := st.chat_input("Ask about your document..."):
 
                     # Show OTHER visuals in a gallery if they exist (so users aren't blind)
                     # Only show this fallback if we were in "Specific" mode or if we missed showing some items
-                    if len(all_images_data) > 0 and intent != "all":
+                    if len(paths) > 0 and intent != "all":
                         with st.expander("🖼️ All Detected Visuals in Context", expanded=False):
                             cols = st.columns(3)
                             shown_count = 0
-                            for i, img_data in enumerate(all_images_data):
+                            for i, (path, page) in enumerate(zip(paths, pages)):
                                 if i in winner_idx_list:
                                     continue # Skip what we just showed
                                 
                                 with cols[shown_count % 3]:
-                                    st.image(img_data["path"], caption=f"Page {img_data['page']}", use_container_width=True)
-                                    if img_data.get("markdown"):
+                                    st.image(path, caption=f"Page {page}", use_container_width=True)
+                                    if markdowns[i]:
                                         with st.popover("View Table"):
-                                            st.markdown(img_data["markdown"])
+                                            st.markdown(markdowns[i])
                                 shown_count += 1
                     
                     with st.expander("📚 View Source Context (Text Only)"):
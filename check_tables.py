@@ -0,0 +1,55 @@
+import argparse
+import multiprocessing
+import os
+import fitz  # PyMuPDF
+
+# Per-process document handle, opened once by the pool initializer (fitz objects are not picklable)
+_doc = None
+
+def _init_worker(file_path):
+    global _doc
+    _doc = fitz.open(file_path)
+
+def _find_tables_worker(page_num, strategy):
+    """
+    Runs PyMuPDF's native table finder on one page.
+    Returns (page_num, number of tables found).
+    """
+    page = _doc.load_page(page_num)
+    tabs = page.find_tables(strategy=strategy)
+    return page_num, len(tabs.tables)
+
+def check_tables(pdf_path, pages=None, strategy="lines_strict", workers=None):
+    print("----- Starting Table Detection Check -----")
+
+    if not os.path.exists(pdf_path):
+        print(f"Error: PDF {pdf_path} not found.")
+        return
+
+    doc = fitz.open(pdf_path)
+    num_pages = len(doc) if pages is None else min(pages, len(doc))
+    doc.close()
+
+    workers = workers or os.cpu_count() or 1
+    print(f"Scanning {num_pages} pages with strategy '{strategy}' on {workers} workers...")
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(pdf_path,)) as pool:
+        results = pool.starmap(_find_tables_worker, [(i, strategy) for i in range(num_pages)])
+
+    for page_num, count in results:
+        if count:
+            print(f"Page {page_num + 1}: {count} table(s)")
+
+    total = sum(count for _, count in results)
+    pages_with_tables = sum(1 for _, count in results if count)
+    print(f"Found {total} tables on {pages_with_tables}/{num_pages} pages.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count the tables PyMuPDF detects in a PDF.")
+    parser.add_argument("pdf", nargs="?", default="multi-modal_rag_qa_assignment.pdf")
+    parser.add_argument("--pages", type=int, default=None, help="Only scan the first N pages")
+    parser.add_argument("--strategy", default="lines_strict", help="find_tables strategy (lines_strict, lines, text)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    check_tables(args.pdf, pages=args.pages, strategy=args.strategy, workers=args.workers)
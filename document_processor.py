@@ -1,270 +1,770 @@
 import os
 import json
-import fitz  # PyMuPDF
-from PIL import Image
+import time
+import asyncio
+import multiprocessing
+import concurrent.futures
+import threading
 import io
-from langchain_core.documents import Document
 # from langchain_google_genai import GoogleGenerativeAI # Removed
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage
+# PyMuPDF, PIL and LangChain are imported where they are used, so importing this module stays cheap
 import base64
 import uuid
+import hashlib
+from typing import Literal
+from pydantic import BaseModel, Field, field_validator
+from llm_clients import get_chat_model, run_async
+
+BASE_IMAGES_DIR = "extracted_images"
+# Parsed Vision responses keyed by image + prompt + model, persisted so re-runs on the same PDF skip the calls
+# (set NO_VISION_CACHE=1 to bypass the disk cache)
+VISION_CACHE_DIR = ".vision_cache"
+
+# Max number of crops sent in a single multi-image Vision call
+CROPS_PER_CALL = 4
+
+# Seconds between status checks of a submitted Batch API job
+BATCH_POLL_SECONDS = 30
+
+# The Vision model cannot resolve more detail than this, so larger images are downscaled
+MAX_VISION_SIDE = 1536
+
+class LayoutItem(BaseModel):
+    type: Literal["table", "chart", "figure"]
+    bbox: list[int] = Field(description="[ymin, xmin, ymax, xmax] on a 0-1000 scale")
+
+    @field_validator("bbox")
+    @classmethod
+    def _four_coordinates(cls, bbox):
+        # Checked here rather than in the JSON schema, so a bad box fails the call (counted, never cached)
+        if len(bbox) != 4:
+            raise ValueError(f"bbox must be [ymin, xmin, ymax, xmax], got {bbox}")
+        return bbox
+
+class LayoutResponse(BaseModel):
+    items: list[LayoutItem]
+
+class CropAnalysis(BaseModel):
+    description: str
+    markdown: str = Field(description="Markdown table for tables, empty string otherwise")
+
+class IndexedCropAnalysis(CropAnalysis):
+    index: int = Field(description="1-based position of the image in the request")
+
+class CropGroupAnalysis(BaseModel):
+    items: list[IndexedCropAnalysis]
+
+# Per-thread JPEG output buffer reused across encodes (crops are encoded on several threads at once)
+_encode_tls = threading.local()
+
+def _encode_for_vision(image_bytes):
+    """
+    Re-encodes an image as a downscaled JPEG and returns it base64-encoded.
+    PNG renders/crops are several times larger than an equivalent JPEG, which
+    directly inflates upload time and Vision input tokens.
+    """
+    from PIL import Image
+    
+    # Context managers release the decoded pixel buffers as soon as the payload is built
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        if img.format == "JPEG" and max(img.size) <= MAX_VISION_SIDE:
+            # Already a small JPEG (e.g. the layout render): send as is instead of re-compressing
+            return base64.b64encode(image_bytes).decode("utf-8")
+        with img.convert("RGB") as rgb:
+            if max(rgb.size) > MAX_VISION_SIDE:
+                rgb.thumbnail((MAX_VISION_SIDE, MAX_VISION_SIDE), Image.LANCZOS)
+            # Reusing the buffer keeps its grown allocation instead of re-growing a fresh one per crop
+            # (it is overwritten from the start, not truncated: truncating would shrink it)
+            buf = getattr(_encode_tls, "buf", None)
+            if buf is None:
+                buf = _encode_tls.buf = io.BytesIO()
+            buf.seek(0)
+            rgb.save(buf, format="JPEG", quality=85, optimize=True)
+            size = buf.tell()
+            with buf.getbuffer() as view, view[:size] as data:
+                return base64.b64encode(data).decode("utf-8")
+
+def _vision_cache_key(image_bytes, prompt, model):
+    """
+    Content-addressable key of a Vision call. BLAKE2b is faster than SHA-256 and
+    collision resistance is all a (non-security) cache key needs.
+    """
+    h = hashlib.blake2b(digest_size=32)
+    h.update(model.encode("utf-8") + b"\0" + prompt.encode("utf-8") + b"\0")
+    h.update(image_bytes)
+    return h.hexdigest()
+
+def _parse_json_response(content):
+    """
+    Parses a JSON answer from the model, tolerating ```json fences.
+    """
+    return json.loads(content.replace("```json", "").replace("```", "").strip())
+
+# Prompts are constants (built once, and part of the Vision cache keys); the structured output
+# schemas enforce the JSON shape, so the prompts only describe the task
+LAYOUT_PROMPT = (
+    "Detect every table (grids, financial statements, lists), chart (bar, line, pie, scatter...) "
+    "and figure (diagrams, flowcharts, illustrations) on this document page. "
+    'Return JSON {"items": [{"type": "table"|"chart"|"figure", "bbox": [ymin, xmin, ymax, xmax]}]}, '
+    "bbox on a 0-1000 scale of the page height/width with 0,0 top-left; empty items if none."
+)
+
+TABLE_CROP_PROMPT = (
+    'This image is a table. Return JSON {"description": a detailed description, '
+    '"markdown": all of its data as a Markdown table with | separators, not wrapped in a code block}.'
+)
+
+VISUAL_CROP_PROMPT = (
+    'Describe this visual element in detail. Return JSON {"description": the description, "markdown": ""}.'
+)
+
+CROP_GROUP_PROMPT = (
+    "Analyze each image below, in order. "
+    'Return JSON {"items": [{"index": 1-based image number, "description": a detailed description, '
+    '"markdown": for tables all of the data as a Markdown table with | separators, else ""}]} '
+    "with exactly one item per image."
+)
+
+def _layout_content(image_bytes):
+    """
+    Builds the message content asking the model for the bounding boxes of a page's visuals.
+    """
+    image_b64 = _encode_for_vision(image_bytes)
+    
+    return [
+        {"type": "text", "text": LAYOUT_PROMPT},
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
+    ]
+
+def _crop_prompt(detected_type):
+    """
+    Returns the prompt asking the model to describe a crop (and extract markdown for tables).
+    """
+    return TABLE_CROP_PROMPT if "table" in detected_type else VISUAL_CROP_PROMPT
+
+def _crop_content(image_bytes, detected_type):
+    """
+    Builds the message content of a crop analysis call.
+    """
+    image_b64 = _encode_for_vision(image_bytes)
+    
+    return [
+        {"type": "text", "text": _crop_prompt(detected_type)},
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
+    ]
+
+def _is_valid_bbox(bbox):
+    """
+    True if bbox is a [ymin, xmin, ymax, xmax] list of 4 numbers.
+    """
+    return (
+        isinstance(bbox, (list, tuple)) and len(bbox) == 4
+        and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in bbox)
+    )
+
+def _normalize_visual_type(label):
+    """
+    Maps a detected label onto one of the crop directories: "table", "chart" or "figure".
+    """
+    if "table" in label:
+        return "table"
+    if any(x in label for x in ["chart", "graph", "plot"]):
+        return "chart"
+    return "figure"
+
+def _write_bytes(path, data):
+    """
+    Writes a file in one go; used by the background I/O pool.
+    """
+    with open(path, "wb") as f:
+        f.write(data)
+
+# State of a render worker process, set once per process by _init_render_worker
+_worker_doc = None
+_worker_precheck = True
+
+def _init_render_worker(file_path, precheck):
+    """
+    Opens the PDF once per worker process (fitz objects are not picklable, and
+    re-opening the file for every page re-parses its structure each time).
+    """
+    import fitz  # PyMuPDF
+    
+    global _worker_doc, _worker_precheck
+    _worker_doc = fitz.open(file_path)
+    _worker_precheck = precheck
+
+def _page_has_visuals(page):
+    """
+    Cheap PyMuPDF check for anything layout detection could find:
+    raster images or any vector drawing (filled, stroked or both: charts, diagrams, ruled tables).
+    Only pages with neither are treated as text-only. Tables laid out with text alone (no rules
+    or fills, common in financial statements) are therefore skipped too; pass
+    skip_text_only_pages=False to DocumentProcessor for such documents.
+    """
+    if page.get_images(full=False):
+        return True
+    return bool(page.get_drawings())
+
+def _render_page_worker(page_num):
+    """
+    Extracts the text of a page and renders a JPEG preview for layout detection.
+    Runs in a worker process set up by _init_render_worker.
+    Returns (page_num, text, img_data); img_data is None for pages without visuals,
+    both are None if the page failed.
+    """
+    import fitz  # PyMuPDF
+    
+    try:
+        page = _worker_doc.load_page(page_num)
+        
+        # 1. Extract Text (Reliable for standard text)
+        text = page.get_text()
+        
+        # Pure text pages (cover, TOC, prose) skip rendering and the layout detection call
+        if _worker_precheck and not _page_has_visuals(page):
+            return page_num, text, None
+        
+        # 2. Render Page as Image for layout detection
+        # Bounding boxes don't need fine detail: up to Matrix(2, 2) (~144 DPI) as JPEG is a fraction
+        # of the upload of a 216 DPI PNG. Crops are re-rendered at full quality later.
+        # The zoom is capped so the longest side fits MAX_VISION_SIDE (Letter/A4 at 2x would not),
+        # so the preview is sent as is instead of being decoded, resized and re-compressed
+        # (one pixel of margin: MuPDF rounds the pixmap size up)
+        zoom = min(2, (MAX_VISION_SIDE - 1) / max(page.rect.width, page.rect.height))
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        img_data = pix.tobytes("jpeg", jpg_quality=85)
+        
+        return page_num, text, img_data
+    except Exception as e:
+        print(f"Error rendering page {page_num}: {e}")
+        return page_num, None, None
 
 class DocumentProcessor:
-    def __init__(self):
-        # Initialize OpenAI Chat model
-        self.llm = ChatOpenAI(model="gpt-4o", api_key=os.getenv("OPENAI_API_KEY"), max_tokens=1500)
+    def __init__(self, max_concurrency=8, workers=None, use_batch_api=False, skip_text_only_pages=True):
+        # Shared OpenAI Chat model (one connection pool for the whole process)
+        self.llm = get_chat_model(max_tokens=1500)
+        # Schema-constrained variants, so responses arrive as valid JSON instead of fenced text
+        self.layout_llm = self.llm.with_structured_output(LayoutResponse)
+        self.crop_llm = self.llm.with_structured_output(CropAnalysis)
+        self.crop_group_llm = self.llm.with_structured_output(CropGroupAnalysis)
+        # Submit Vision calls as OpenAI Batch API jobs (half the cost, but minutes-to-hours latency)
+        # instead of interactive requests
+        self.use_batch_api = use_batch_api
+        # Max number of in-flight crop analysis requests
+        self.max_concurrency = max_concurrency
+        # Number of processes used for the CPU-bound page extraction (defaults to all cores)
+        self.workers = workers or os.cpu_count() or 1
+        # Skip layout detection on pages where PyMuPDF finds no images or vector drawings
+        self.skip_text_only_pages = skip_text_only_pages
+        # Content-hash keyed caches: Vision responses (in memory, backed by VISION_CACHE_DIR)
+        # and already-saved crop files
+        self._vision_cache = {}
+        self._use_disk_cache = not os.getenv("NO_VISION_CACHE")
+        self._saved_paths = {}
+        # Vision calls that failed during the last process_pdf run (their pages lack those visuals)
+        self.vision_failures = 0
+        # Background pool for crop image writes, so disk latency stays off the hot path
+        # (writes are sequential on disk anyway; two threads keep the queue moving)
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self._pending_writes = []
+
+    def _cache_get(self, key):
+        """
+        Returns the cached parsed response of a Vision call, or None on a miss.
+        """
+        if key in self._vision_cache:
+            return self._vision_cache[key]
+        if not self._use_disk_cache:
+            return None
+        try:
+            with open(os.path.join(VISION_CACHE_DIR, f"{key}.json"), "r", encoding="utf-8") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._vision_cache[key] = value
+        return value
 
-    def process_pdf(self, file_path):
+    def _cache_put(self, key, value):
+        """
+        Stores the parsed response of a successful Vision call, in memory and on disk.
+        """
+        self._vision_cache[key] = value
+        if not self._use_disk_cache:
+            return
+        try:
+            os.makedirs(VISION_CACHE_DIR, exist_ok=True)
+            with open(os.path.join(VISION_CACHE_DIR, f"{key}.json"), "w", encoding="utf-8") as f:
+                json.dump(value, f)
+        except OSError as e:
+            print(f"Error saving Vision cache entry: {e}")
+
+    def process_pdf(self, file_path, window=64):
         """
         Extracts text and visual elements (Tables/Charts) using Vision-based detection.
         Renders pages to images, visual-detects bounding boxes, crops, and analyzes them.
-        Uses Parallel Processing for speed.
+        Uses a process pool for page extraction and concurrent async calls
+        for layout detection and crop analysis.
+        Yields the page Documents in page order, window pages at a time. At most two windows of
+        rendered pages (the one being analyzed and the next one) are held in memory, and callers
+        can ingest early pages while later ones are still processed.
         """
-        import concurrent.futures
+        import fitz  # PyMuPDF
         
+        self.vision_failures = 0
         doc = fitz.open(file_path)
         num_pages = len(doc)
         doc.close()
         
+        # Each Batch API job waits minutes to hours, so batch mode submits the whole document at once
+        if self.use_batch_api:
+            window = max(num_pages, 1)
+        
         # Base directories
-        base_images_dir = "extracted_images"
         dirs = {
-            "table": os.path.join(base_images_dir, "tables"),
-            "chart": os.path.join(base_images_dir, "charts"),
-            "figure": os.path.join(base_images_dir, "figures")
+            "table": os.path.join(BASE_IMAGES_DIR, "tables"),
+            "chart": os.path.join(BASE_IMAGES_DIR, "charts"),
+            "figure": os.path.join(BASE_IMAGES_DIR, "figures")
         }
         
         for d in dirs.values():
             if not os.path.exists(d):
                 os.makedirs(d)
 
-        documents = []
-        
-        # Parallel processing of pages
-        print(f"Starting parallel processing of {num_pages} pages...")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            # Map page numbers to futures
-            future_to_page = {
-                executor.submit(self._process_page, page_num, file_path, dirs): page_num 
-                for page_num in range(num_pages)
-            }
-            
-            # Collect results as they complete (but we need to reorder them later)
-            results = []
-            for future in concurrent.futures.as_completed(future_to_page):
-                page_num = future_to_page[future]
-                try:
-                    doc_obj = future.result()
-                    results.append((page_num, doc_obj))
-                    print(f"Page {page_num+1} processed successfully.")
-                except Exception as exc:
-                    print(f"Page {page_num+1} generated an exception: {exc}")
-
-        # Sort results by page number to maintain document order
-        results.sort(key=lambda x: x[0])
-        documents = [r[1] for r in results if r[1] is not None]
+        # Phase 1: Extract text and render pages across processes (CPU-bound), one window at a time
+        print(f"Rendering {num_pages} pages with {self.workers} workers...")
+        windows = [range(i, min(i + window, num_pages)) for i in range(0, num_pages, window)]
+        with multiprocessing.Pool(min(self.workers, max(num_pages, 1)), initializer=_init_render_worker, initargs=(file_path, self.skip_text_only_pages)) as pool:
+            pending = pool.map_async(_render_page_worker, windows[0]) if windows else None
+            for n in range(len(windows)):
+                rendered = pending.get()
+                # Prefetch only the next window while this one waits on the network, so renders
+                # never pile up further ahead than that
+                pending = pool.map_async(_render_page_worker, windows[n + 1]) if n + 1 < len(windows) else None
+                yield from self._process_window(file_path, dirs, rendered)
+
+    def _process_window(self, file_path, dirs, rendered):
+        """
+        Runs layout detection, cropping and crop analysis for a window of rendered pages.
+        Yields their Documents in page order.
+        """
+        # Phase 2: Layout detection of the rendered pages that may contain visuals (not yet cached)
+        rendered = [r for r in rendered if r[1] is not None]
+        to_detect = [r for r in rendered if r[2] is not None]
+        print(f"{len(rendered) - len(to_detect)} text-only pages skip layout detection.")
+        detections = {}
+        layout_keys = {}
+        misses = []
+        for r in to_detect:
+            key = _vision_cache_key(r[2], LAYOUT_PROMPT, self.llm.model_name)
+            cached = self._cache_get(key)
+            # Entries with malformed boxes (cached before responses were validated) are detected again
+            if cached is not None and all(_is_valid_bbox(item.get("bbox")) for item in cached):
+                detections[r[0]] = cached
+            else:
+                layout_keys[r[0]] = key
+                misses.append(r)
+        print(f"Detecting layout of {len(misses)} pages ({len(to_detect) - len(misses)} cached)...")
+        if self.use_batch_api:
+            fresh = self._detect_pages_batch(misses)
+        else:
+            fresh = run_async(self._adetect_pages(misses))
+        for page_num, detected_items in fresh.items():
+            self._cache_put(layout_keys[page_num], detected_items)
+        detections.update(fresh)
+        self.vision_failures += len(misses) - len(fresh)
             
-        return documents
+        # Phase 2b: High-quality crops, rendered only for pages where visuals were detected
+        results = self._crop_pages(file_path, rendered, detections)
+        
+        # Start writing the crop files now, so the disk I/O overlaps the Vision calls below
+        for page_num, page_data in results:
+            for crop in page_data["crops"]:
+                self._save_crop(crop, page_num, file_path, dirs)
+        
+        # Phase 3: Analyze every unique, not yet cached crop concurrently (network-bound)
+        jobs = [crop for _, page_data in results for crop in page_data["crops"]]
+        pending = {}
+        for crop in jobs:
+            if crop["key"] not in pending and self._cache_get(crop["key"]) is None:
+                pending[crop["key"]] = crop
+        print(f"Analyzing {len(pending)} visual elements concurrently ({len(jobs) - len(pending)} cached or duplicate)...")
+        if self.use_batch_api:
+            fresh = self._analyze_crops_batch(list(pending.values()))
+        else:
+            fresh = run_async(self._analyze_crops(list(pending.values())))
+        
+        for key, analysis in zip(pending, fresh):
+            if isinstance(analysis, Exception):
+                print(f"Error analyzing crop: {analysis}")
+            elif analysis:
+                self._cache_put(key, analysis)
+                continue
+            self.vision_failures += 1
+        analyses = [self._vision_cache.get(crop["key"]) for crop in jobs]
+        
+        # Make sure every crop file exists before the Documents referencing them are handed out
+        for future in self._pending_writes:
+            try:
+                future.result()
+            except OSError as e:
+                print(f"Error saving crop image: {e}")
+        self._pending_writes = []
+        
+        # Phase 4: Scatter analyses back to their pages and build the Documents
+        offset = 0
+        for page_num, page_data in results:
+            page_analyses = analyses[offset : offset + len(page_data["crops"])]
+            offset += len(page_data["crops"])
+            yield self._build_document(page_num, file_path, page_data, page_analyses)
 
-    def _process_page(self, page_num, file_path, dirs):
+    async def _adetect_pages(self, rendered):
         """
-        Process a single page: Extract text, render image, detect layout, crop, and analyze.
-        Opens its own file handle for thread safety.
+        Detects the layout of all rendered pages concurrently, bounded by a semaphore
+        to respect rate limits.
+        Returns {page_num: detected_items}; pages whose detection failed are left out.
         """
+        print(f"Starting concurrent layout detection of {len(rendered)} pages...")
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        page_results = await asyncio.gather(
+            *[self._adetect_layout(img_data, semaphore) for _, _, img_data in rendered],
+            return_exceptions=True
+        )
+        
+        detections = {}
+        for (page_num, _, _), detected_items in zip(rendered, page_results):
+            if isinstance(detected_items, Exception):
+                print(f"Page {page_num+1} generated an exception: {detected_items}")
+            elif detected_items is not None:
+                detections[page_num] = detected_items
+        return detections
+
+    def _detect_pages_batch(self, rendered):
+        """
+        Detects the layout of all rendered pages in one Batch API job.
+        Returns {page_num: detected_items}; pages whose detection failed are left out.
+        """
+        responses = self._run_batch(
+            {f"page_{page_num}": _layout_content(img_data) for page_num, _, img_data in rendered},
+            "layout_detection"
+        )
+        
+        detections = {}
+        for page_num, _, _ in rendered:
+            try:
+                # JSON mode doesn't enforce the schema, so validate like the structured output path does
+                # (a failed page is left out: counted as a failure and never cached)
+                layout = LayoutResponse.model_validate(_parse_json_response(responses[f"page_{page_num}"]))
+                detections[page_num] = [item.model_dump() for item in layout.items]
+            except Exception as e:
+                print(f"Error detecting layout on page {page_num + 1}: {e}")
+        return detections
+
+    def _crop_pages(self, file_path, rendered, detections):
+        """
+        Crops the detected visuals of every page from a single open document.
+        Returns [(page_num, page_data)] in page order.
+        """
+        import fitz  # PyMuPDF
+        
+        results = []
+        doc = fitz.open(file_path)
         try:
-            # Open document locally for thread safety
-            doc = fitz.open(file_path)
-            page = doc.load_page(page_num)
+            for page_num, text, _ in rendered:
+                page_data = self._crop_page(doc.load_page(page_num), page_num, text, detections.get(page_num, []))
+                results.append((page_num, page_data))
+                print(f"Page {page_num+1} processed.")
+        finally:
+            doc.close()
+        return results
+
+    def _crop_page(self, page, page_num, text, detected_items):
+        """
+        Crops the detected items out of a page.
+        Returns a dict with the page text and the list of crops awaiting analysis.
+        Items with a malformed box are skipped; if cropping fails, the page keeps its text
+        with no crops and the failure is counted in vision_failures.
+        """
+        import fitz  # PyMuPDF
+        import numpy as np
+        
+        # Keep the original positions (used in crop file names) of the items with a usable box
+        boxed = [(idx, item) for idx, item in enumerate(detected_items) if _is_valid_bbox(item.get("bbox"))]
+        if len(boxed) < len(detected_items):
+            print(f"Page {page_num+1}: skipping {len(detected_items) - len(boxed)} items with a malformed bbox.")
+            self.vision_failures += 1
+        if not boxed:
+            return {"text": text, "crops": []}
             
-            # 1. Extract Text (Reliable for standard text)
-            text = page.get_text()
+        try:
+            crops = []
             
-            # 2. Render Page as Image for Vision (Higher DPI for better quality)
-            # Matrix(3, 3) approximates ~216 DPI if base is 72, or often results in ~300 DPI effectively depending on PDF
-            pix = page.get_pixmap(matrix=fitz.Matrix(3, 3)) 
-            img_data = pix.tobytes("png")
-            full_page_image = Image.open(io.BytesIO(img_data))
+            # Convert all 0-1000 scale [ymin, xmin, ymax, xmax] boxes to page coordinates (PDF points) at once
+            rect = page.rect
+            size = np.array([rect.width, rect.height, rect.width, rect.height])
+            origin = np.array([rect.x0, rect.y0, rect.x0, rect.y0])
+            bboxes = np.array([item["bbox"] for _, item in boxed], dtype=float)
             
-            # 3. Detect Tables/Charts/Figures via Vision
-            # Note: _detect_layout calls LLM
-            detected_items = self._detect_layout(img_data)
+            # Add padding (e.g., 2% of dimension) so we don't cut off labels, then clamp to the page
+            pad = np.array([-0.02, -0.02, 0.02, 0.02]) * size
+            clips = origin + bboxes[:, [1, 0, 3, 2]] * size / 1000 + pad
+            clips = np.clip(clips, [rect.x0, rect.y0, rect.x0, rect.y0], [rect.x1, rect.y1, rect.x1, rect.y1])
             
-            page_image_metadata = []
-            visual_descriptions = []
+            # Ensure valid boxes
+            valid = (clips[:, 2] > clips[:, 0]) & (clips[:, 3] > clips[:, 1])
             
-            for idx, item in enumerate(detected_items):
-                bbox = item.get("bbox") # [ymin, xmin, ymax, xmax] (0-1000 scale)
-                label = item.get("type", "figure").lower()
-                
-                # Convert 0-1000 scale to pixel coordinates
-                w, h = full_page_image.size
-                ymin, xmin, ymax, xmax = bbox
-                
-                # Add padding (e.g., 2% of dimension) so we don't cut off labels
-                pad_x = int(w * 0.02)
-                pad_y = int(h * 0.02)
-                
-                crop_box = (
-                    max(0, int(xmin * w / 1000) - pad_x), 
-                    max(0, int(ymin * h / 1000) - pad_y), 
-                    min(w, int(xmax * w / 1000) + pad_x), 
-                    min(h, int(ymax * h / 1000) + pad_y)
-                )
-                
-                # Crop
-                # Ensure valid box
-                if crop_box[2] <= crop_box[0] or crop_box[3] <= crop_box[1]:
+            for (idx, item), coords, ok in zip(boxed, clips.tolist(), valid.tolist()):
+                if not ok:
                     continue
-                    
-                crop_img = full_page_image.crop(crop_box)
-                
-                # Convert crop to bytes
-                buf = io.BytesIO()
-                crop_img.save(buf, format="PNG")
-                crop_bytes = buf.getvalue()
-                
-                # Generate Unique ID for this visual element to link it strongly with text
-                visual_id = str(uuid.uuid4())[:8] # Short unique ID
+                label = item.get("type", "figure").lower()
+                clip = fitz.Rect(*coords)
                 
-                # Analyze Crop (Get detailed description + Markdown for tables)
-                # We prioritize the label from detection, but allow analysis to refine description
-                # If detected as table, we explicitly ask for markdown
-                analysis = self._analyze_crop(crop_bytes, label)
+                # Render only the clipped region at high resolution
+                # Matrix(3, 3) approximates ~216 DPI if base is 72, or often results in ~300 DPI effectively depending on PDF
+                crop_bytes = page.get_pixmap(matrix=fitz.Matrix(3, 3), clip=clip).tobytes("png")
                 
-                if analysis:
-                    valid_type = label # Trust the detection type primarily
-                    description = analysis.get("description", "")
-                    table_md = analysis.get("markdown", "")
-                    
-                    # Normalize directory
-                    target_dir = dirs["figure"] # Default
-                    
-                    if "table" in valid_type: 
-                        target_dir = dirs["table"]
-                        valid_type = "table" # Normalize name
-                    elif any(x in valid_type for x in ["chart", "graph", "plot"]): 
-                        target_dir = dirs["chart"]
-                        valid_type = "chart" # Normalize name
-                    else:
-                        valid_type = "figure" # Normalize name
-                    
-                    # Save Crop for reference
-                    image_filename = f"{valid_type}_{os.path.basename(file_path)}_{page_num}_{idx}.png"
-                    image_path = os.path.join(target_dir, image_filename)
-                    with open(image_path, "wb") as f:
-                        f.write(crop_bytes)
-                        
-                    # Store Metadata including the Unique ID
-                    page_image_metadata.append({
-                        "id": visual_id,
-                        "path": image_path,
-                        "type": valid_type,
-                        "description": description,
-                        "markdown": table_md if "table" in valid_type else ""
-                    })
-                    
-                    # Add to content with the ID explicitly
-                    # This ensures that when this text chunk is retrieved, we have the ID to lookup the image
-                    if "table" in valid_type and table_md:
-                        visual_descriptions.append(f"\n[Detected Table ID: {visual_id}] (Page {page_num + 1}):\n{description}\n\nReconstructed Table Data:\n{table_md}\n")
-                    else:
-                        visual_descriptions.append(f"\n[Detected {valid_type.capitalize()} ID: {visual_id}] (Page {page_num + 1}):\n{description}\n")
-
-            # Final Page Content
-            final_content = text + "\n".join(visual_descriptions)
-            
-            doc.close()
+                # Content hash to dedupe Vision calls. A crop's analysis may come from its single-crop prompt
+                # (which depends on the label, since tables also get markdown) or from a grouped call,
+                # so both prompts are part of the key and changing either invalidates the entry
+                key = _vision_cache_key(crop_bytes, _crop_prompt(label) + "\0" + CROP_GROUP_PROMPT, self.llm.model_name)
+                crops.append({"idx": idx, "label": label, "bytes": crop_bytes, "key": key})
             
-            return Document(
-                page_content=final_content,
-                metadata={
-                    "source": file_path, 
-                    "page": page_num + 1,
-                    "image_metadata": json.dumps(page_image_metadata)
-                }
-            )
+            return {"text": text, "crops": crops}
         except Exception as e:
             print(f"Error processing page {page_num}: {e}")
-            return None
+            self.vision_failures += 1
+            return {"text": text, "crops": []}
 
-    def _detect_layout(self, image_bytes):
+    def _save_crop(self, crop, page_num, file_path, dirs):
         """
-        Sends full page to GPT-4o to get bounding boxes for tables and charts.
-        Returns list of dicts: [{'type': 'table'|'chart'|'figure', 'bbox': [ymin, xmin, ymax, xmax]}]
+        Queues the crop image for writing on the I/O pool (identical crops reuse the file already queued).
+        Returns the path it is saved to.
         """
-        try:
-            image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-            
-            prompt = """Look at this document page. Detect all:
-            1. Tables (any grid-like data, financial statements, or list structures).
-            2. Charts / Graphs (bar, line, pie, scatter, etc.).
-            3. Figures (diagrams, flowcharts, technical illustrations).
+        image_path = self._saved_paths.get(crop["key"])
+        if not image_path:
+            valid_type = _normalize_visual_type(crop["label"])
+            image_filename = f"{valid_type}_{os.path.basename(file_path)}_{page_num}_{crop['idx']}.png"
+            image_path = os.path.join(dirs[valid_type], image_filename)
+            self._pending_writes.append(self._io_pool.submit(_write_bytes, image_path, crop["bytes"]))
+            self._saved_paths[crop["key"]] = image_path
+        return image_path
+
+    def _build_document(self, page_num, file_path, page_data, analyses):
+        """
+        Assembles the final Document of a page from its text and analyzed crops.
+        """
+        from langchain_core.documents import Document
+        
+        page_image_metadata = []
+        visual_descriptions = []
+        
+        for crop, analysis in zip(page_data["crops"], analyses):
+            if not analysis:
+                continue
+                
+            label = crop["label"]
             
-            Return a JSON object with a key "items" containing a list of detected objects.
-            For each object, provide:
-            - "type": EXACTLY one of "table", "chart", or "figure". Do not use "image" or "other".
-            - "bbox": [ymin, xmin, ymax, xmax] 
-              where coordinates are on a 0-1000 scale (relative to image height/width). 
-              0,0 is top-left. 1000,1000 is bottom-right.
+            # Generate Unique ID for this visual element to link it strongly with text
+            visual_id = str(uuid.uuid4())[:8] # Short unique ID
             
-            Example:
-            { "items": [ {"type": "table", "bbox": [100, 50, 400, 950]} ] }
+            valid_type = _normalize_visual_type(label) # Trust the detection type primarily
+            description = analysis.get("description", "")
+            table_md = analysis.get("markdown", "")
             
-            If nothing found, return { "items": [] }
-            """
+            # Crop file written by _save_crop
+            image_path = self._saved_paths[crop["key"]]
+                
+            # Store Metadata including the Unique ID
+            page_image_metadata.append({
+                "id": visual_id,
+                "path": image_path,
+                "type": valid_type,
+                "description": description,
+                "markdown": table_md if "table" in valid_type else ""
+            })
             
-            message = HumanMessage(
-                content=[
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
-                ]
-            )
+            # Add to content with the ID explicitly
+            # This ensures that when this text chunk is retrieved, we have the ID to lookup the image
+            # (the "ID: ...]" tag is what patterns.ID_PATTERN matches)
+            if "table" in valid_type and table_md:
+                visual_descriptions.append(f"\n[Detected Table ID: {visual_id}] (Page {page_num + 1}):\n{description}\n\nReconstructed Table Data:\n{table_md}\n")
+            else:
+                visual_descriptions.append(f"\n[Detected {valid_type.capitalize()} ID: {visual_id}] (Page {page_num + 1}):\n{description}\n")
+
+        # Final Page Content
+        final_content = page_data["text"] + "\n".join(visual_descriptions)
+        
+        return Document(
+            page_content=final_content,
+            metadata={
+                "source": file_path, 
+                "page": page_num + 1,
+                "image_metadata": json.dumps(page_image_metadata)
+            }
+        )
+
+    async def _adetect_layout(self, image_bytes, semaphore):
+        """
+        Sends full page to GPT-4o to get bounding boxes for tables and charts.
+        Returns list of dicts: [{'type': 'table'|'chart'|'figure', 'bbox': [ymin, xmin, ymax, xmax]}],
+        or None if the detection failed.
+        """
+        from langchain_core.messages import HumanMessage
+        
+        try:
+            # Encoding is CPU work: keep it off the shared event loop (as for crops)
+            message = HumanMessage(content=await asyncio.to_thread(_layout_content, image_bytes))
             
-            response = self.llm.invoke([message], config={"run_name": "layout_detection"})
-            content = response.content.replace("```json", "").replace("```", "").strip()
-            data = json.loads(content)
-            return data.get("items", [])
+            async with semaphore:
+                response = await self.layout_llm.ainvoke([message], config={"run_name": "layout_detection"})
+            return [item.model_dump() for item in response.items]
             
         except Exception as e:
             print(f"Error detecting layout: {e}")
-            return []
+            return None
 
-    def _analyze_crop(self, image_bytes, detected_type):
+    async def _analyze_crops(self, crops):
         """
-        Analyzes a specific crop. If type is table, extracts markdown.
+        Fires the analysis of all crops concurrently, bounded by a semaphore to respect rate limits.
+        Crops are grouped CROPS_PER_CALL at a time into multi-image calls to save round trips.
+        Returns one result per crop in the same order (None or the Exception on failure).
         """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        groups = [crops[i : i + CROPS_PER_CALL] for i in range(0, len(crops), CROPS_PER_CALL)]
+        group_results = await asyncio.gather(
+            *[self._aanalyze_crop_group(group, semaphore) for group in groups],
+            return_exceptions=True
+        )
+        
+        results = []
+        for group, group_result in zip(groups, group_results):
+            if isinstance(group_result, Exception):
+                results.extend([group_result] * len(group))
+            else:
+                results.extend(group_result)
+        return results
+
+    async def _aanalyze_crop_group(self, crops, semaphore):
+        """
+        Analyzes several crops in one multi-image call.
+        Falls back to one call per crop if the response can't be matched back to the crops.
+        """
+        from langchain_core.messages import HumanMessage
+        
+        if len(crops) == 1:
+            return [await self._aanalyze_crop(crops[0]["bytes"], crops[0]["label"], semaphore)]
+            
         try:
-            image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+            # Only the list of table images varies per call
+            tables = [str(i) for i, crop in enumerate(crops, start=1) if "table" in crop["label"]]
+            prompt = CROP_GROUP_PROMPT
+            if tables:
+                prompt += f" Images {', '.join(tables)} are tables."
             
-            type_instruction = ""
-            if "table" in detected_type:
-                type_instruction = "This is a table. Extract all data into a standard Markdown table format in the 'markdown' field."
-            else:
-                type_instruction = "Describe this visual element in detail."
-                
-            prompt = f"""Analyze this image crop.
-            {type_instruction}
-            Provide a detailed "description".
+            # Re-encoding is CPU work: run it off the event loop so crops of all pages encode in parallel
+            # (PIL releases the GIL while resizing and compressing)
+            encoded = await asyncio.gather(*[asyncio.to_thread(_encode_for_vision, crop["bytes"]) for crop in crops])
+            content_parts = [{"type": "text", "text": prompt}]
+            for image_b64 in encoded:
+                content_parts.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}})
             
-            Return JSON:
-            {{
-                "description": "...",
-                "markdown": "..." (If table: strictly use standard Markdown table syntax with | separators. Do not wrap in ```markdown code blocks inside the JSON value.)
-            }}
-            """
+            async with semaphore:
+                response = await self.crop_group_llm.ainvoke([HumanMessage(content=content_parts)], config={"run_name": "crop_analysis_batch"})
+            items = sorted(response.items, key=lambda item: item.index)
             
-            message = HumanMessage(
-                content=[
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
-                ]
-            )
+            # Only trust the mapping if the indices are exactly 1..n (no duplicates, gaps or 0-based numbering)
+            if [item.index for item in items] == list(range(1, len(crops) + 1)):
+                return [{"description": item.description, "markdown": item.markdown} for item in items]
+            print(f"Batch analysis returned indices {[item.index for item in items]} for {len(crops)} crops, falling back to single calls.")
+        except Exception as e:
+            print(f"Error in batch crop analysis, falling back to single calls: {e}")
             
-            response = self.llm.invoke([message], config={"run_name": "crop_analysis"})
-            content = response.content.replace("```json", "").replace("```", "").strip()
-            return json.loads(content)
+        return await asyncio.gather(
+            *[self._aanalyze_crop(crop["bytes"], crop["label"], semaphore) for crop in crops]
+        )
+
+    async def _aanalyze_crop(self, image_bytes, detected_type, semaphore):
+        """
+        Analyzes a specific crop. If type is table, extracts markdown.
+        """
+        from langchain_core.messages import HumanMessage
+        
+        try:
+            message = HumanMessage(content=await asyncio.to_thread(_crop_content, image_bytes, detected_type))
+            
+            async with semaphore:
+                response = await self.crop_llm.ainvoke([message], config={"run_name": "crop_analysis"})
+            return response.model_dump()
             
         except Exception as e:
             print(f"Error analyzing crop: {e}")
             return None
+
+    def _analyze_crops_batch(self, crops):
+        """
+        Analyzes all crops in one Batch API job.
+        Returns one result per crop in the same order (None on failure).
+        """
+        responses = self._run_batch(
+            {f"crop_{i}": _crop_content(crop["bytes"], crop["label"]) for i, crop in enumerate(crops)},
+            "crop_analysis"
+        )
+        
+        results = []
+        for i in range(len(crops)):
+            try:
+                analysis = CropAnalysis.model_validate(_parse_json_response(responses[f"crop_{i}"]))
+                results.append(analysis.model_dump())
+            except Exception as e:
+                print(f"Error analyzing crop: {e}")
+                results.append(None)
+        return results
+
+    def _run_batch(self, requests, run_name):
+        """
+        Submits {custom_id: message content} as one OpenAI Batch API job and waits for it to finish.
+        Returns {custom_id: response text} for the requests that succeeded.
+        """
+        if not requests:
+            return {}
+            
+        from openai import OpenAI
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        
+        lines = [
+            json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.llm.model_name,
+                    "max_tokens": self.llm.max_tokens,
+                    # Batch requests are raw HTTP bodies, so JSON mode stands in for the structured output schemas
+                    "response_format": {"type": "json_object"},
+                    "messages": [{"role": "user", "content": content}]
+                }
+            })
+            for custom_id, content in requests.items()
+        ]
+        batch_file = client.files.create(file=(f"{run_name}.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        print(f"Submitted {run_name} batch {batch.id} with {len(lines)} requests...")
+        
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(BATCH_POLL_SECONDS)
+            batch = client.batches.retrieve(batch.id)
+            print(f"Batch {batch.id}: {batch.status}")
+            
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"Batch {batch.id} ended with status {batch.status}.")
+            return {}
+            
+        results = {}
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") == 200:
+                results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        return results
@@ -0,0 +1,58 @@
+import os
+import asyncio
+import functools
+import threading
+
+# One HTTP connection pool for every OpenAI call in the process, so TLS handshakes are paid once
+# and HTTP/2 multiplexes concurrent requests over a few connections.
+# Everything is created on first use, so importing this module stays cheap.
+
+@functools.lru_cache(maxsize=None)
+def get_http_clients():
+    """
+    Returns the shared (sync, async) httpx clients.
+    Timeouts match the OpenAI SDK defaults (Vision calls can take well over httpx's 5s default).
+    """
+    import httpx
+
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    timeout = httpx.Timeout(600.0, connect=5.0)
+    return (
+        httpx.Client(http2=True, limits=limits, timeout=timeout),
+        httpx.AsyncClient(http2=True, limits=limits, timeout=timeout)
+    )
+
+@functools.lru_cache(maxsize=None)
+def _event_loop():
+    """
+    Starts the event loop all async LLM calls run on.
+    Pooled async connections are bound to the loop that opened them, so the shared
+    AsyncClient must never be used from a second loop (e.g. a fresh asyncio.run).
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """
+    Runs a coroutine on the shared event loop and blocks until it returns.
+    Safe to call from any thread, including concurrently.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result()
+
+@functools.lru_cache(maxsize=None)
+def get_chat_model(model="gpt-4o", max_tokens=None):
+    """
+    Returns the shared chat model for these settings.
+    Per-call options such as temperature should be set with .bind() rather than a new model.
+    """
+    from langchain_openai import ChatOpenAI
+
+    http_client, http_async_client = get_http_clients()
+    return ChatOpenAI(
+        model=model,
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_tokens=max_tokens,
+        http_client=http_client,
+        http_async_client=http_async_client
+    )
@@ -0,0 +1,4 @@
+import re
+
+# Visual IDs embedded in chunk text by DocumentProcessor: e.g. [Detected Table ID: 52a1b3c4]
+ID_PATTERN = re.compile(r"ID:\s*([a-zA-Z0-9-]+)\]")
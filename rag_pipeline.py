@@ -1,26 +1,148 @@
-import chromadb
 import os
 import time
 import json
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_chroma import Chroma
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+import uuid
+import array
+import sqlite3
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from langchain_core.embeddings import Embeddings
+from llm_clients import get_chat_model, get_http_clients
+# ChromaDB and the OpenAI/Chroma integrations are imported where they are used,
+# so importing this module (e.g. for CachedEmbeddings) doesn't pay their startup cost
+
+__all__ = ["MultiModalRAG", "CachedEmbeddings", "HNSW_METADATA"]
+
+# HNSW index settings applied when the collection is created
+# (cosine matches the normalized OpenAI embeddings; ef/M trade a little build time for recall)
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 100,
+    "hnsw:M": 32
+}
+
+def _retry_after_seconds(error):
+    """
+    Returns the wait requested by a rate-limited response's Retry-After header, or None.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model with a persistent SQLite cache keyed by the SHA-256 of each text,
+    so re-ingesting unchanged content makes no embedding API calls.
+    """
+    def __init__(self, underlying, db_path):
+        self.underlying = underlying
+        self.db_path = db_path
+        # Part of the key, so switching models never returns vectors of the wrong model
+        self.namespace = getattr(underlying, "model", "")
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB)")
+        finally:
+            # The context manager only commits; the connection must be closed explicitly
+            conn.close()
+        
+    def _connect(self):
+        # Ingestion embeds batches from several threads, so writers wait for the lock instead of failing
+        return sqlite3.connect(self.db_path, timeout=30)
+        
+    def _key(self, text):
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).hexdigest()
+        
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        found = {}
+        
+        conn = self._connect()
+        try:
+            # Look up hits (chunked to stay under SQLite's bound-parameter limit)
+            unique_keys = list(dict.fromkeys(keys))
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({placeholders})", batch)
+                for key, blob in rows:
+                    found[key] = array.array("d", blob).tolist()
+            
+            # Embed only the misses, once per distinct text
+            misses = {}
+            for key, text in zip(keys, texts):
+                if key not in found:
+                    misses.setdefault(key, text)
+            if misses:
+                print(f"Embedding cache: {len(unique_keys) - len(misses)} hits, {len(misses)} misses")
+                vectors = self.underlying.embed_documents(list(misses.values()))
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                        [(key, array.array("d", vec).tobytes()) for key, vec in zip(misses, vectors)]
+                    )
+                found.update(zip(misses, vectors))
+        finally:
+            conn.close()
+            
+        return [found[key] for key in keys]
+        
+    def embed_query(self, text):
+        return self.underlying.embed_query(text)
 
 class MultiModalRAG:
-    def __init__(self, persist_directory="./chroma_db"):
-        self.embeddings = OpenAIEmbeddings(model="text-embedding-3-small", api_key=os.getenv("OPENAI_API_KEY"))
+    def __init__(self, persist_directory="./chroma_db", images_dir="extracted_images", hnsw_metadata=None,
+                 embedding_cache_path="./embedding_cache.db"):
+        from langchain_openai import OpenAIEmbeddings
+        
+        self.embeddings = CachedEmbeddings(
+            OpenAIEmbeddings(model="text-embedding-3-small", api_key=os.getenv("OPENAI_API_KEY"),
+                             http_client=get_http_clients()[0]),
+            embedding_cache_path
+        )
         self.persist_directory = persist_directory
+        self.hnsw_metadata = hnsw_metadata or HNSW_METADATA
+        self.images_dir = images_dir
         self.vector_store = None
+        self.retriever = None
+        self._answer_chain = None
+        self._qa_chain = None
+        self.valid_image_paths = frozenset()
+        self.refresh_image_paths()
         
-    def ingest_documents(self, documents):
+    def refresh_image_paths(self):
+        """
+        Scans the extracted images directory once so callers can check crop paths
+        with a set lookup instead of a stat() per image per turn.
+        """
+        self.valid_image_paths = frozenset(
+            os.path.join(root, name)
+            for root, _, files in os.walk(self.images_dir)
+            for name in files
+        )
+        
+    def ingest_documents(self, documents, batch_size=1000, max_concurrency=8):
         """
         Chunks documents and stores them in ChromaDB with rate limit handling.
+        documents may be any iterable (e.g. the generator returned by process_pdf): it is
+        consumed incrementally, and every batch_size chunks are embedded concurrently
+        (up to max_concurrency requests in flight) and bulk-inserted as their vectors arrive.
         """
+        import chromadb
+        from langchain_chroma import Chroma
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_documents(documents)
         
         client = chromadb.PersistentClient(path=self.persist_directory)
         
@@ -30,55 +152,112 @@ class MultiModalRAG:
         except Exception:
             pass  # Collection doesn't exist or other error, which is fine for reset
             
-        # Initialize the collection
+        # Initialize the collection (and drop chains bound to the previous one)
+        self.retriever = None
+        self._qa_chain = None
         self.vector_store = Chroma(
             client=client,
             collection_name="rag_collection",
-            embedding_function=self.embeddings
+            embedding_function=self.embeddings,
+            collection_metadata=self.hnsw_metadata
         )
         
-        # Batch processing with retries
-        batch_size = 50 # OpenAI handles larger batches better usually, but keeping it safe
-        total_chunks = len(chunks)
-        print(f"Processing {total_chunks} chunks in batches of {batch_size}...")
+        # Chroma rejects a single add() larger than its max batch size
+        max_batch_size = getattr(client, "get_max_batch_size", lambda: batch_size)()
+        batch_size = min(batch_size, max_batch_size)
         
-        for i in range(0, total_chunks, batch_size):
-            batch = chunks[i : i + batch_size]
-            retry_count = 0
-            max_retries = 5
+        total_chunks = 0
+        in_flight = collections.deque()
+        
+        def insert_oldest():
+            # Bulk insert the precomputed vectors (IDs are pre-generated, so batch order doesn't matter to Chroma)
+            texts, metadatas, future = in_flight.popleft()
+            self.vector_store._collection.add(
+                ids=[str(uuid.uuid4()) for _ in texts],
+                embeddings=future.result(),
+                documents=texts,
+                metadatas=metadatas
+            )
+            print(f"Processed batch of {len(texts)} chunks ({total_chunks} chunked so far)")
+        
+        # Embedding batches are independent HTTP calls: run them concurrently
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            chunks = []
             
-            while retry_count < max_retries:
-                try:
-                    self.vector_store.add_documents(documents=batch)
-                    print(f"Processed batch {i//batch_size + 1}/{(total_chunks + batch_size - 1)//batch_size}")
-                    break
-                except Exception as e:
-                    if "429" in str(e) or "quota" in str(e).lower():
-                        retry_count += 1
-                        wait_time = 2 ** retry_count
-                        print(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                        time.sleep(wait_time)
-                    else:
-                        raise e
+            def submit(batch):
+                texts = [chunk.page_content for chunk in batch]
+                metadatas = [chunk.metadata for chunk in batch]
+                in_flight.append((texts, metadatas, executor.submit(self._embed_with_retry, texts)))
+                # Bound memory: never hold more batches than can be embedded at once
+                if len(in_flight) > max_concurrency:
+                    insert_oldest()
             
-            if retry_count == max_retries:
-                print(f"Failed to process batch causing error after {max_retries} retries.")
+            for document in documents:
+                new_chunks = text_splitter.split_documents([document])
+                chunks.extend(new_chunks)
+                total_chunks += len(new_chunks)
+                while len(chunks) >= batch_size:
+                    submit(chunks[:batch_size])
+                    chunks = chunks[batch_size:]
+            if chunks:
+                submit(chunks)
+            while in_flight:
+                insert_oldest()
+                
+        print(f"Ingested {total_chunks} chunks.")
             
-            # Rate limiting delay
-            time.sleep(1)
+        # Pick up the crops written for the new documents
+        self.refresh_image_paths()
         
-    def get_qa_chain(self):
+    def _embed_with_retry(self, texts, max_retries=5):
         """
-        Returns a QA chain for answering questions.
+        Embeds texts, waiting out rate limit errors for as long as the API asks
+        (Retry-After), or backing off exponentially if it doesn't say.
+        """
+        retry_count = 0
+        while True:
+            try:
+                return self.embeddings.embed_documents(texts)
+            except Exception as e:
+                rate_limited = getattr(e, "status_code", None) == 429 or "429" in str(e) or "quota" in str(e).lower()
+                if rate_limited and retry_count < max_retries:
+                    retry_count += 1
+                    wait_time = _retry_after_seconds(e) or 2 ** retry_count
+                    print(f"Rate limit hit. Retrying in {wait_time} seconds...")
+                    time.sleep(wait_time)
+                else:
+                    if retry_count == max_retries:
+                        print(f"Failed to embed chunks after {max_retries} retries.")
+                    raise e
+        
+    def get_retriever(self):
+        """
+        Returns the retriever over the vector store, built once per instance.
         """
         if not self.vector_store:
+            import chromadb
+            from langchain_chroma import Chroma
+            
             # Try loading existing DB
             client = chromadb.PersistentClient(path=self.persist_directory)
-            self.vector_store = Chroma(client=client, collection_name="rag_collection", embedding_function=self.embeddings)
+            self.vector_store = Chroma(client=client, collection_name="rag_collection", embedding_function=self.embeddings, collection_metadata=self.hnsw_metadata)
             
-        llm = ChatOpenAI(model="gpt-4o", api_key=os.getenv("OPENAI_API_KEY"), temperature=0)
+        if self.retriever is None:
+            self.retriever = self.vector_store.as_retriever(search_kwargs={"k": 5})
+        return self.retriever
         
-        retriever = self.vector_store.as_retriever(search_kwargs={"k": 5})
+    def get_answer_chain(self):
+        """
+        Returns the answer-generation chain over already retrieved documents.
+        Takes {"input": question, "context": [Document, ...]} and returns the answer string.
+        """
+        if self._answer_chain is not None:
+            return self._answer_chain
+            
+        from langchain_core.prompts import ChatPromptTemplate
+        from langchain_core.output_parsers import StrOutputParser
+        
+        llm = get_chat_model().bind(temperature=0)
         
         prompt = ChatPromptTemplate.from_template(
             """You are a Multimodal Document Analysis Model.
@@ -136,14 +315,30 @@ class MultiModalRAG:
             return "\n\n".join(doc.page_content for doc in docs)
         
         # Build the chain using LCEL
-        rag_chain = (
-            {"context": retriever | format_docs, "question": RunnablePassthrough()}
+        self._answer_chain = (
+            {"context": lambda x: format_docs(x["context"]), "question": itemgetter("input")}
             | prompt
             | llm
             | StrOutputParser()
         )
         
-        return rag_chain
+        return self._answer_chain
+        
+    def get_qa_chain(self):
+        """
+        Returns a QA chain for answering questions.
+        The chain takes {"input": question} and returns a dict with the retrieved
+        "context" documents and the "answer", so retrieval only runs once per question.
+        """
+        if self._qa_chain is None:
+            from langchain_core.runnables import RunnablePassthrough
+            
+            # Retrieve once, then feed the same docs to the answer and back to the caller
+            self._qa_chain = RunnablePassthrough.assign(
+                context=itemgetter("input") | self.get_retriever()
+            ).assign(answer=self.get_answer_chain())
+        
+        return self._qa_chain
 
     def select_best_visual_match(self, query : str, candidates : list):
         """
@@ -183,7 +378,7 @@ class MultiModalRAG:
         print(f"DEBUG: Selection Prompt:\n{prompt}")
         
         try:
-            llm = ChatOpenAI(model="gpt-4o", api_key=os.getenv("OPENAI_API_KEY"), temperature=0)
+            llm = get_chat_model().bind(temperature=0)
             result = llm.invoke(prompt)
             content = result.content.replace("```json", "").replace("```", "").strip()
             print(f"DEBUG: Selection Result: {content}")
@@ -1,6 +1,8 @@
 import os
 import sys
+import json
 from dotenv import load_dotenv
+from patterns import ID_PATTERN
 from rag_pipeline import MultiModalRAG
 from document_processor import DocumentProcessor
 
@@ -37,24 +39,19 @@ def test_retrieval():
         print(f"\n[TESTING {type_label.upper()} RETRIEVAL]")
         print(f"Query: {query}")
         
-        # 1. Get Answer
-        answer = qa_chain.invoke(query)
+        # 1. Get Answer (the chain also returns the docs it retrieved)
+        result = qa_chain.invoke({"input": query})
+        answer = result["answer"]
         print(f"Answer Preview: {answer[:150]}...")
         
-        # 2. Check Retrieval & Visual Selection
-        retriever = rag.vector_store.as_retriever(search_kwargs={"k": 5})
-        source_docs = retriever.invoke(query)
+        # 2. Check Retrieval & Visual Selection on the same docs (no second vector search)
+        source_docs = result["context"]
         
         # Extract Candidates like App.py does
         candidates = []
-        import json
-        import re
-        id_pattern = re.compile(r"ID:\s*([a-zA-Z0-9-]+)\]")
-        found_ids = set()
+        found_ids = {m.group(1) for doc in source_docs for m in ID_PATTERN.finditer(doc.page_content)}
         
         for doc in source_docs:
-            found_ids.update(id_pattern.findall(doc.page_content))
-            
             if "image_metadata" in doc.metadata:
                 try:
                     meta = json.loads(doc.metadata["image_metadata"])